@@ -10,7 +10,6 @@ Usage:
 
 import argparse
 from pathlib import Path
-import csv
 import sys
 
 # Import queries
@@ -26,7 +25,7 @@ def run_queries(queries, optimized_dir: Path, out_dir: Path):
     # Ensure output directory exists
     out_dir.mkdir(parents=True, exist_ok=True)
 
-    # Initialize query engine
+    # Initialize query engine and pre-load aggregates once
     engine = QueryEngine(optimized_dir)
 
     results = []
@@ -42,22 +41,16 @@ def run_queries(queries, optimized_dir: Path, out_dir: Path):
             # Execute query
             result_df, execution_time = engine.execute_query(query)
 
-            # Convert to list of rows for CSV output
-            columns = result_df.columns
-            rows = result_df.rows()
+            print(f"   ✅ Rows: {result_df.height} | Time: {execution_time:.3f}s\n")
 
-            print(f"   ✅ Rows: {len(rows)} | Time: {execution_time:.3f}s\n")
-
-            # Save to CSV
+            # Save to CSV natively, keeping the space-separated datetime
+            # format csv.writer produced
             out_path = out_dir / f"q{i}.csv"
-            with out_path.open("w", newline="") as f:
-                writer = csv.writer(f)
-                writer.writerow(columns)
-                writer.writerows(rows)
+            result_df.write_csv(out_path, datetime_format="%Y-%m-%d %H:%M:%S")
 
             results.append({
                 "query": i,
-                "rows": len(rows),
+                "rows": result_df.height,
                 "time": execution_time
             })
             total_time += execution_time
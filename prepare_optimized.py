@@ -5,101 +5,215 @@ Optimized Data Preparation Phase - Parallel & Memory-Efficient
 Designed for MacBook M2 with 16GB RAM constraint.
 
 Features:
-- Parallel CSV processing using multiprocessing (6 workers)
+- Parallel CSV processing with threads; a couple of files in flight at a time
 - Streaming: Never loads entire dataset into memory
-- Incremental partitioning with append mode
+- Hive-style partitions (type=X/day=Y/) holding one file per CSV part
 - Efficient aggregation from partition files
-- ZSTD compression level 3 for balanced compression
+- ZSTD level 1 for partitions (fast encode), level 3 for aggregates
 
 Usage:
   python prepare_optimized.py --data-dir ./data/data-full --optimized-dir ./optimized_data_full
 """
 
 import polars as pl
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
 from pathlib import Path
 import time
 import shutil
-from multiprocessing import Pool, cpu_count
-from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
 import os
+import subprocess
+import sys
+import threading
 
 # Enable global string cache for categorical columns
 # This is required when concatenating DataFrames with categorical columns
 pl.enable_string_cache()
 
 
-def process_csv_with_worker_id(args):
-    """Wrapper function for multiprocessing that unpacks arguments"""
-    csv_file, worker_id, optimized_dir, schema = args
-    return process_csv_file(csv_file, optimized_dir, schema, worker_id)
+EVENT_TYPES = ["serve", "impression", "click", "purchase"]
+
+# CSV schema, shared by every file
+CSV_SCHEMA = {
+    "ts": pl.Int64,
+    "type": pl.Categorical,
+    "auction_id": pl.Utf8,
+    "advertiser_id": pl.Int32,
+    "publisher_id": pl.Int32,
+    "bid_price": pl.Float64,
+    "user_id": pl.Int64,
+    "total_price": pl.Float64,
+    "country": pl.Categorical,
+}
+
+# CSV files processed concurrently. The CSV parser and Parquet writer
+# release the GIL, so threads overlap without worker processes; memory
+# holds this many files at once
+FILES_IN_FLIGHT = 2
+
+# Arrow equivalents of the Polars CSV schema types; categoricals are read
+# straight into dictionary arrays
+ARROW_TYPES = {
+    pl.Int32: pa.int32(),
+    pl.Int64: pa.int64(),
+    pl.Float64: pa.float64(),
+    pl.Utf8: pa.string(),
+    pl.Categorical: pa.dictionary(pa.int32(), pa.string()),
+}
+
+# Column order within partition files: small fixed-width columns first, so
+# the 2-4 columns aggregates project sit in adjacent byte ranges, then
+# floats, then the wide columns
+PARTITION_COLUMNS = [
+    "day", "type", "country", "advertiser_id", "publisher_id",
+    "bid_price", "total_price", "ts", "auction_id", "user_id",
+]
+
+# Not read by the aggregates or the bundled queries, but part of the
+# documented schema, so they are kept by default. auction_id UUIDs are the
+# widest column by bytes; --drop-unused-columns skips them when not needed
+UNUSED_COLUMNS = ["auction_id", "user_id"]
+
+# Large row groups for partition shards keep footer metadata small; small
+# row groups for aggregates keep their min/max statistics selective
+PARTITION_ROW_GROUP_SIZE = 524_288
+AGGREGATE_ROW_GROUP_SIZE = 65_536
+
+# CSV block size per parser thread; a few MB keeps each block cache-resident
+CSV_BLOCK_SIZE = 16 << 20
+
+# Row order within each partition file, by the key its dominant
+# aggregates group on; clustered keys also make min/max statistics prune.
+# Impression shards lead with country for the country aggregates. The
+# order only holds within a shard, so a scan over several shards must
+# not be marked set_sorted
+PARTITION_SORT_KEYS = {
+    "impression": ["country", "publisher_id"],
+}
+DEFAULT_SORT_KEYS = ["advertiser_id"]
+
+
+def default_thread_count() -> int:
+    """
+    Cores that CPU-bound Polars threads should use.
+    On Linux this honours the affinity mask (and so cgroup CPU sets); on
+    Apple Silicon it counts performance cores only, since E-cores would
+    roughly halve per-thread throughput. Falls back to cpu_count().
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+
+    if sys.platform == "darwin":
+        try:
+            result = subprocess.run(
+                ["sysctl", "-n", "hw.perflevel0.physicalcpu"],
+                capture_output=True,
+                text=True,
+            )
+            if result.returncode == 0:
+                return int(result.stdout.strip())
+        except (OSError, ValueError):
+            pass
+
+    return cpu_count()
 
 
-def process_csv_file(csv_file: Path, optimized_dir: Path, schema: dict, worker_id: int):
+def process_csv_file(csv_file: Path, partitioned_dir: Path, schema: dict):
     """
     Process a single CSV file: load, transform, and partition.
-    This function runs in a separate process.
-    Writes to temporary worker-specific files to avoid race conditions.
+    pyarrow's threaded CSV reader parses the file block by block.
+    Each partition gets one file per CSV part, so nothing needs merging.
 
     Returns: (file_name, row_count, processing_time)
     """
     start = time.time()
 
-    temp_dir = optimized_dir / "temp" / f"worker_{worker_id}"
-    temp_dir.mkdir(parents=True, exist_ok=True)
-
-    # Read CSV with schema
-    df = pl.scan_csv(
+    # Parse straight into Arrow buffers, then add the derived columns
+    table = pa_csv.read_csv(
         csv_file,
-        schema=schema,
-        null_values=["", "null"],
-    ).collect()
-
-    # Add derived columns
-    df = df.with_columns([
-        pl.from_epoch(pl.col("ts"), time_unit="ms").alias("ts_dt"),
-    ]).with_columns([
-        pl.col("ts_dt").dt.date().alias("day"),
-        pl.col("ts_dt").dt.truncate("1w").cast(pl.Date).alias("week"),
-        pl.col("ts_dt").dt.truncate("1h").alias("hour"),
-        pl.col("ts_dt").dt.strftime("%Y-%m-%d %H:%M").alias("minute"),
-    ])
+        read_options=pa_csv.ReadOptions(block_size=CSV_BLOCK_SIZE),
+        convert_options=pa_csv.ConvertOptions(
+            column_types={name: ARROW_TYPES[dtype] for name, dtype in schema.items()},
+            include_columns=list(schema),
+            null_values=["", "null"],
+            strings_can_be_null=True,
+        ),
+    )
+    df = pl.from_arrow(table).with_columns([
+        # Only the partition key is stored; week/hour/minute are derived
+        # from ts where needed (aggregates here, the query engine on reads).
+        # Date is physically Int32 days since epoch, so one floor division
+        # replaces the datetime conversion
+        (pl.col("ts") // 86_400_000).cast(pl.Int32).cast(pl.Date).alias("day"),
+    ]).select([c for c in PARTITION_COLUMNS if c in schema or c == "day"])
 
     row_count = len(df)
 
-    # Partition by type and day, write to temp directory
-    for event_type in ["serve", "impression", "click", "purchase"]:
-        type_df = df.filter(pl.col("type") == event_type)
+    # Partition by type and day into type=X/day=Y/<csv stem>.parquet in a
+    # single radix-partition pass instead of a filter per type and day
+    parts = df.partition_by(["type", "day"], as_dict=True)
 
-        if len(type_df) == 0:
+    for (event_type, day), day_df in parts.items():
+        if event_type not in EVENT_TYPES:
             continue
 
-        type_dir = temp_dir / f"type={event_type}"
-        type_dir.mkdir(exist_ok=True)
-
-        # Group by day and write each partition
-        days = type_df["day"].unique().sort().to_list()
+        day_df = day_df.sort(PARTITION_SORT_KEYS.get(event_type, DEFAULT_SORT_KEYS))
+        day_dir = partitioned_dir / f"type={event_type}" / f"day={day}"
+        day_dir.mkdir(parents=True, exist_ok=True)
 
-        for day in days:
-            day_df = type_df.filter(pl.col("day") == day)
-            day_str = str(day)
-
-            # Write to temp file with CSV file name to make it unique
-            output_file = type_dir / f"day={day_str}_{csv_file.stem}.parquet"
-            day_df.write_parquet(
-                output_file,
-                compression="zstd",
-                compression_level=3,  # Balanced compression
-                statistics=True,
-            )
+        # Name the shard after its CSV file to make it unique
+        output_file = day_dir / f"{csv_file.stem}.parquet"
+        day_df.write_parquet(
+            output_file,
+            compression="zstd",
+            compression_level=1,  # Encode speed over ratio for bulk data
+            statistics=True,
+            row_group_size=PARTITION_ROW_GROUP_SIZE,
+        )
 
     elapsed = time.time() - start
     return (csv_file.name, row_count, elapsed)
 
 
+def scan_partitions(partitioned_dir: Path, event_type: str):
+    """Lazy scan over every shard of one event type, or None if it has none"""
+    type_dir = partitioned_dir / f"type={event_type}"
+    if not any(type_dir.glob("day=*/*.parquet")):
+        return None
+    return pl.scan_parquet(type_dir / "day=*" / "*.parquet")
+
+
+def group_by_codes(lf: pl.LazyFrame, keys: list, aggs: list) -> pl.LazyFrame:
+    """
+    Multi-column group-by that hashes categorical keys by their u32 codes.
+    Polars 1.16's streaming engine cannot row-encode categorical keys read
+    from Parquet, so each categorical is grouped by its physical code and
+    its value is carried through with first().
+    """
+    schema = lf.collect_schema()
+    categoricals = [k for k in keys if schema[k] == pl.Categorical]
+    codes = [f"{k}_code" for k in categoricals]
+
+    by = [
+        pl.col(k).to_physical().alias(f"{k}_code") if k in categoricals else pl.col(k)
+        for k in keys
+    ]
+    return (
+        lf
+        .group_by(by)
+        .agg([pl.col(k).first() for k in categoricals] + aggs)
+        .select(keys + [pl.exclude(keys + codes)])
+    )
+
+
 def compute_aggregates_parallel(optimized_dir: Path):
     """
-    Compute aggregates from partitioned files in parallel.
-    Each aggregate computation can run independently.
+    Compute all aggregates from partitioned files in one fused plan.
+    Aggregates over the same event type branch off a shared scan, so each
+    partition file is decoded once for all of them.
     """
     partitioned_dir = optimized_dir / "partitioned"
     aggregates_dir = optimized_dir / "aggregates"
@@ -107,171 +221,112 @@ def compute_aggregates_parallel(optimized_dir: Path):
 
     print("\n⚡ Computing aggregates in parallel...")
 
-    # Define aggregate computation functions
-    def compute_daily_revenue():
-        print("   [1/5] Daily revenue...")
-        impression_files = sorted((partitioned_dir / "type=impression").glob("day=*.parquet"))
-
-        dfs = []
-        for f in impression_files:
-            df = pl.scan_parquet(f).select(["day", "bid_price"])
-            dfs.append(df)
-
-        if dfs:
-            result = (
-                pl.concat(dfs)
-                .group_by("day")
-                .agg([
-                    pl.col("bid_price").sum().alias("sum_bid_price"),
-                    pl.col("bid_price").count().alias("count_impressions"),
-                ])
-                .sort("day")
-                .collect()
-            )
-            result.write_parquet(
-                aggregates_dir / "daily_revenue.parquet",
-                compression="zstd",
-            )
-        return "daily_revenue"
-
-    def compute_country_aggregates():
-        print("   [2/5] Country aggregates...")
-
-        # Country revenue
-        impression_files = sorted((partitioned_dir / "type=impression").glob("day=*.parquet"))
-        dfs = []
-        for f in impression_files:
-            df = pl.scan_parquet(f).select(["country", "bid_price"])
-            dfs.append(df)
-
-        if dfs:
-            result = (
-                pl.concat(dfs)
-                .group_by("country")
-                .agg([
-                    pl.col("bid_price").sum().alias("sum_bid_price"),
-                    pl.col("bid_price").count().alias("count_impressions"),
-                ])
-                .collect()
-            )
-            result.write_parquet(
-                aggregates_dir / "country_revenue.parquet",
+    impressions = scan_partitions(partitioned_dir, "impression")
+    purchases = scan_partitions(partitioned_dir, "purchase")
+    # type is constant within its partition directory, so advertiser-type
+    # counts group each type by advertiser_id alone: the 4-value type key
+    # never enters a hash table
+    per_type_counts = [
+        lf
+        .group_by("advertiser_id")
+        .agg([
+            pl.col("type").first(),
+            pl.len().alias("count"),
+        ])
+        for lf in (scan_partitions(partitioned_dir, t) for t in EVENT_TYPES)
+        if lf is not None
+    ]
+
+    # Small, fixed-size results are collected together; results that grow
+    # with the data are streamed straight to disk with sink_parquet
+    plans = {}
+    sinks = {}
+
+    if impressions is not None:
+        plans["daily_revenue.parquet"] = (
+            impressions
+            .group_by("day")
+            .agg([
+                pl.col("bid_price").sum().alias("sum_bid_price"),
+                pl.col("bid_price").count().alias("count_impressions"),
+            ])
+            .sort("day")
+        )
+        plans["country_revenue.parquet"] = (
+            impressions
+            .group_by("country")
+            .agg([
+                pl.col("bid_price").sum().alias("sum_bid_price"),
+                pl.col("bid_price").count().alias("count_impressions"),
+            ])
+        )
+        sinks["publisher_day_country_revenue.parquet"] = (
+            group_by_codes(impressions, ["publisher_id", "day", "country"], [
+                pl.col("bid_price").sum().alias("sum_bid_price"),
+            ])
+        )
+        sinks["minute_revenue.parquet"] = (
+            impressions
+            .group_by(["day", (pl.col("ts") // 60_000).alias("minute_epoch")])
+            .agg([
+                pl.col("bid_price").sum().alias("sum_bid_price"),
+            ])
+            .select([
+                "day",
+                pl.from_epoch(pl.col("minute_epoch") * 60, time_unit="s")
+                .dt.strftime("%Y-%m-%d %H:%M")
+                .alias("minute"),
+                "sum_bid_price",
+            ])
+        )
+
+    if purchases is not None:
+        plans["country_purchases.parquet"] = (
+            purchases
+            .group_by("country")
+            .agg([
+                pl.col("total_price").sum().alias("sum_total_price"),
+                pl.col("total_price").mean().alias("avg_total_price"),
+                pl.col("total_price").count().alias("count_purchases"),
+            ])
+        )
+
+    if per_type_counts:
+        plans["advertiser_type_counts.parquet"] = pl.concat(per_type_counts)
+
+    print(f"   Computing {len(plans) + len(sinks)} aggregates...")
+
+    # Polars releases the GIL while executing, so the sinks, the fused
+    # collect and the result writes all overlap on a thread pool
+    with ThreadPoolExecutor(max_workers=len(sinks) + len(plans) or 1) as pool:
+        jobs = [
+            pool.submit(
+                lf.sink_parquet,
+                aggregates_dir / filename,
                 compression="zstd",
+                compression_level=3,
+                row_group_size=AGGREGATE_ROW_GROUP_SIZE,
             )
+            for filename, lf in sinks.items()
+        ]
 
-        # Country purchases
-        purchase_files = sorted((partitioned_dir / "type=purchase").glob("day=*.parquet"))
-        dfs = []
-        for f in purchase_files:
-            df = pl.scan_parquet(f).select(["country", "total_price"])
-            dfs.append(df)
-
-        if dfs:
-            result = (
-                pl.concat(dfs)
-                .group_by("country")
-                .agg([
-                    pl.col("total_price").sum().alias("sum_total_price"),
-                    pl.col("total_price").mean().alias("avg_total_price"),
-                    pl.col("total_price").count().alias("count_purchases"),
-                ])
-                .collect()
-            )
-            result.write_parquet(
-                aggregates_dir / "country_purchases.parquet",
-                compression="zstd",
-            )
+        # collect_all executes the remaining plans together; common-subplan
+        # elimination shares the impression scan across them
+        results = pl.collect_all(list(plans.values()), streaming=True)
 
-        return "country_aggregates"
-
-    def compute_publisher_day_revenue():
-        print("   [3/5] Publisher-day revenue...")
-        impression_files = sorted((partitioned_dir / "type=impression").glob("day=*.parquet"))
-
-        dfs = []
-        for f in impression_files:
-            df = pl.scan_parquet(f).select(["publisher_id", "day", "country", "bid_price"])
-            dfs.append(df)
-
-        if dfs:
-            result = (
-                pl.concat(dfs)
-                .group_by(["publisher_id", "day", "country"])
-                .agg([
-                    pl.col("bid_price").sum().alias("sum_bid_price"),
-                ])
-                .collect()
-            )
-            result.write_parquet(
-                aggregates_dir / "publisher_day_country_revenue.parquet",
+        jobs += [
+            pool.submit(
+                result.write_parquet,
+                aggregates_dir / filename,
                 compression="zstd",
+                compression_level=3,
+                row_group_size=AGGREGATE_ROW_GROUP_SIZE,
             )
+            for filename, result in zip(plans, results)
+        ]
 
-        return "publisher_day_revenue"
-
-    def compute_advertiser_type_counts():
-        print("   [4/5] Advertiser-type counts...")
-
-        # Scan all event types
-        dfs = []
-        for event_type in ["serve", "impression", "click", "purchase"]:
-            type_dir = partitioned_dir / f"type={event_type}"
-            if not type_dir.exists():
-                continue
-
-            files = sorted(type_dir.glob("day=*.parquet"))
-            for f in files:
-                df = pl.scan_parquet(f).select(["advertiser_id", "type"])
-                dfs.append(df)
-
-        if dfs:
-            result = (
-                pl.concat(dfs)
-                .group_by(["advertiser_id", "type"])
-                .agg([
-                    pl.len().alias("count"),
-                ])
-                .collect()
-            )
-            result.write_parquet(
-                aggregates_dir / "advertiser_type_counts.parquet",
-                compression="zstd",
-            )
-
-        return "advertiser_type_counts"
-
-    def compute_minute_revenue():
-        print("   [5/5] Minute-level revenue...")
-        impression_files = sorted((partitioned_dir / "type=impression").glob("day=*.parquet"))
-
-        dfs = []
-        for f in impression_files:
-            df = pl.scan_parquet(f).select(["day", "minute", "bid_price"])
-            dfs.append(df)
-
-        if dfs:
-            result = (
-                pl.concat(dfs)
-                .group_by(["day", "minute"])
-                .agg([
-                    pl.col("bid_price").sum().alias("sum_bid_price"),
-                ])
-                .collect()
-            )
-            result.write_parquet(
-                aggregates_dir / "minute_revenue.parquet",
-                compression="zstd",
-            )
-
-        return "minute_revenue"
-
-    # Run aggregates sequentially (they're already optimized with lazy evaluation)
-    # Running in parallel could exceed memory limits
-    compute_daily_revenue()
-    compute_country_aggregates()
-    compute_publisher_day_revenue()
-    compute_advertiser_type_counts()
-    compute_minute_revenue()
+        for job in jobs:
+            job.result()
 
     print("   ✅ All aggregates computed")
 
@@ -282,34 +337,29 @@ def create_statistics(optimized_dir: Path):
 
     partitioned_dir = optimized_dir / "partitioned"
 
-    # Collect stats by scanning partition files (lazy)
+    # Walk the type=X/day=Y directories once: the names already carry the
+    # keys, and row counts come straight from the Parquet footers
     total_rows = 0
     type_counts = {}
+    impression_days = []
 
-    for event_type in ["serve", "impression", "click", "purchase"]:
+    for event_type in EVENT_TYPES:
         type_dir = partitioned_dir / f"type={event_type}"
         if not type_dir.exists():
             continue
 
-        files = list(type_dir.glob("day=*.parquet"))
         type_count = 0
-
-        for f in files:
-            df = pl.scan_parquet(f).select(pl.len())
-            type_count += df.collect()[0, 0]
+        for day_dir in type_dir.glob("day=*"):
+            if event_type == "impression":
+                impression_days.append(day_dir.name[len("day="):])
+            type_count += sum(pq.ParquetFile(f).metadata.num_rows for f in day_dir.glob("*.parquet"))
 
         type_counts[event_type] = type_count
         total_rows += type_count
 
-    # Get date range from impression partitions
-    impression_dir = partitioned_dir / "type=impression"
-    if impression_dir.exists():
-        files = sorted(impression_dir.glob("day=*.parquet"))
-        if files:
-            min_day = files[0].stem.split("=")[1]
-            max_day = files[-1].stem.split("=")[1]
-        else:
-            min_day = max_day = "unknown"
+    # Date range from impression partitions
+    if impression_days:
+        min_day, max_day = min(impression_days), max(impression_days)
     else:
         min_day = max_day = "unknown"
 
@@ -333,81 +383,38 @@ def create_statistics(optimized_dir: Path):
 
 
 class OptimizedDataPreparer:
-    def __init__(self, data_dir: Path, optimized_dir: Path, num_workers: int = None):
+    def __init__(self, data_dir: Path, optimized_dir: Path, num_workers: int = None,
+                 drop_unused_columns: bool = False):
         self.data_dir = Path(data_dir)
+        self.drop_unused_columns = drop_unused_columns
         self.optimized_dir = Path(optimized_dir)
         self.partitioned_dir = self.optimized_dir / "partitioned"
 
-        # Determine optimal worker count
+        # One process handles the files in turn; Polars' own thread pool
+        # provides the parallelism, so all cores share one memory budget
         if num_workers is None:
-            # Use 75% of CPU cores, capped at 6 for memory safety on 16GB RAM
-            num_workers = min(6, max(1, int(cpu_count() * 0.75)))
+            num_workers = default_thread_count()
         self.num_workers = num_workers
-
-    def _merge_temp_partitions(self):
-        """Merge temporary partition files from all workers into final partitions"""
-        temp_dir = self.optimized_dir / "temp"
-
-        if not temp_dir.exists():
-            return
-
-        # Collect all temp partition files by type and day
-        partition_files = {}  # (type, day) -> [file_paths]
-
-        for worker_dir in temp_dir.glob("worker_*"):
-            for type_dir in worker_dir.glob("type=*"):
-                event_type = type_dir.name.split("=")[1]
-
-                for parquet_file in type_dir.glob("day=*.parquet"):
-                    # Extract day from filename (format: day=YYYY-MM-DD_events_part_*.parquet)
-                    filename = parquet_file.stem
-                    day_str = filename.split("_")[0].split("=")[1]  # Get YYYY-MM-DD
-
-                    key = (event_type, day_str)
-                    if key not in partition_files:
-                        partition_files[key] = []
-                    partition_files[key].append(parquet_file)
-
-        # Merge files for each partition
-        print(f"   Merging {len(partition_files)} unique partitions...")
-
-        for (event_type, day_str), file_list in partition_files.items():
-            # Create final partition directory
-            type_dir = self.partitioned_dir / f"type={event_type}"
-            type_dir.mkdir(parents=True, exist_ok=True)
-
-            output_file = type_dir / f"day={day_str}.parquet"
-
-            if len(file_list) == 1:
-                # Only one file, just move it
-                shutil.move(str(file_list[0]), str(output_file))
-            else:
-                # Multiple files, concatenate them efficiently with lazy loading
-                dfs = [pl.scan_parquet(f) for f in file_list]
-                combined = pl.concat(dfs).collect()
-                combined.write_parquet(
-                    output_file,
-                    compression="zstd",
-                    compression_level=3,  # Balanced compression
-                    statistics=True,
-                )
-
-        # Clean up temp directory
-        shutil.rmtree(temp_dir)
-        print(f"   ✅ Merged successfully")
+        os.environ["POLARS_MAX_THREADS"] = str(num_workers)
 
     def prepare(self):
         """Main preparation pipeline"""
         print("🚀 Starting optimized data preparation (parallel & streaming)")
-        print(f"   Workers: {self.num_workers}")
+        print(f"   Threads: {self.num_workers}")
         print(f"   CPU cores: {cpu_count()}")
 
         start_time = time.time()
 
-        # Clean up existing optimized directory
+        # Clean up existing optimized directory: one os.replace moves it
+        # aside, and the unlinks run on a background thread while the new
+        # data is prepared
         if self.optimized_dir.exists():
             print(f"\n🗑️  Cleaning existing directory...")
-            shutil.rmtree(self.optimized_dir)
+            old_dir = self.optimized_dir.with_name(self.optimized_dir.name + ".old")
+            if old_dir.exists():
+                shutil.rmtree(old_dir)
+            os.replace(self.optimized_dir, old_dir)
+            threading.Thread(target=shutil.rmtree, args=(old_dir,)).start()
 
         # Create directories
         self.partitioned_dir.mkdir(parents=True, exist_ok=True)
@@ -420,30 +427,20 @@ class OptimizedDataPreparer:
 
         print(f"\n📊 Found {len(csv_files)} CSV files to process")
 
-        # Define schema
-        schema = {
-            "ts": pl.Int64,
-            "type": pl.Utf8,
-            "auction_id": pl.Utf8,
-            "advertiser_id": pl.Int32,
-            "publisher_id": pl.Int32,
-            "bid_price": pl.Float64,
-            "user_id": pl.Int64,
-            "total_price": pl.Float64,
-            "country": pl.Utf8,
-        }
-
-        # Step 1: Process CSV files in parallel
-        print(f"\n🔄 Processing CSV files with {self.num_workers} workers...")
-
-        # Assign each CSV file to a worker ID and pack arguments
-        csv_with_workers = [
-            (csv_file, i % self.num_workers, self.optimized_dir, schema)
-            for i, csv_file in enumerate(csv_files)
-        ]
+        # Dropped columns are skipped by the CSV parser itself
+        schema = CSV_SCHEMA
+        if self.drop_unused_columns:
+            schema = {k: v for k, v in schema.items() if k not in UNUSED_COLUMNS}
 
-        with Pool(processes=self.num_workers) as pool:
-            results = pool.map(process_csv_with_worker_id, csv_with_workers)
+        # Step 1: Process CSV files; each one is parsed in parallel, and a
+        # few files are in flight so one's parse overlaps another's writes
+        print(f"\n🔄 Processing CSV files with {self.num_workers} threads...")
+
+        with ThreadPoolExecutor(max_workers=FILES_IN_FLIGHT) as pool:
+            results = list(pool.map(
+                lambda csv_file: process_csv_file(csv_file, self.partitioned_dir, schema),
+                csv_files,
+            ))
 
         total_rows = sum(r[1] for r in results)
         avg_time = sum(r[2] for r in results) / len(results)
@@ -452,10 +449,6 @@ class OptimizedDataPreparer:
         print(f"   Total rows: {total_rows:,}")
         print(f"   Avg processing time per file: {avg_time:.2f}s")
 
-        # Step 1.5: Merge temporary partition files
-        print(f"\n🔗 Merging partition files...")
-        self._merge_temp_partitions()
-
         # Step 2: Compute aggregates
         compute_aggregates_parallel(self.optimized_dir)
 
@@ -467,7 +460,6 @@ class OptimizedDataPreparer:
         print(f"📁 Optimized data stored in: {self.optimized_dir}")
 
         # Show disk usage
-        import subprocess
         try:
             result = subprocess.run(
                 ["du", "-sh", str(self.optimized_dir)],
@@ -503,12 +495,20 @@ def main():
         "--workers",
         type=int,
         default=None,
-        help="Number of parallel workers (default: auto-detect, max 6)"
+        help="Number of Polars threads (default: usable performance cores)"
+    )
+
+    parser.add_argument(
+        "--drop-unused-columns",
+        action="store_true",
+        help="Leave auction_id and user_id out of the partitioned data"
     )
 
     args = parser.parse_args()
 
-    preparer = OptimizedDataPreparer(args.data_dir, args.optimized_dir, args.workers)
+    preparer = OptimizedDataPreparer(
+        args.data_dir, args.optimized_dir, args.workers, args.drop_unused_columns
+    )
     preparer.prepare()
 
 
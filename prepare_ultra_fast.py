@@ -6,7 +6,7 @@ Optimized for speed over storage size.
 
 Key optimizations for speed:
 - Skip most aggregations (compute on-demand)
-- Use minimal compression (ZSTD level 1)
+- Use LZ4 compression (cheapest encode)
 - Skip pre-sorting
 - Max parallelism (all CPU cores)
 - Only essential aggregates (3 instead of 5)
@@ -16,104 +16,124 @@ Usage:
 """
 
 import polars as pl
+import pyarrow.parquet as pq
 from pathlib import Path
 import time
 import shutil
-from multiprocessing import Pool, cpu_count
-from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
 import os
+import threading
 
-# Enable global string cache for categorical columns
-# This is required when concatenating DataFrames with categorical columns
+EVENT_TYPES = ["serve", "impression", "click", "purchase"]
+
+# Enable global string cache for categorical columns. type and country
+# are Categorical rather than Enum so values outside a fixed list (e.g.
+# "UK") pass through like in the other layouts instead of failing the
+# whole run; shards and partial aggregates built on different threads
+# share this one dictionary
 pl.enable_string_cache()
 
+# CSV files processed concurrently. Polars already parses each file on all
+# cores and releases the GIL, so a couple of threads in one process replace
+# the worker pool; memory holds this many files at once
+FILES_IN_FLIGHT = 2
 
-def process_csv_with_worker_id(args):
-    """Wrapper function for multiprocessing that unpacks arguments"""
-    csv_file, worker_id, optimized_dir, schema = args
-    return process_csv_file(csv_file, optimized_dir, schema, worker_id)
+# Rows per Parquet row group (~50-80 MB at this schema's width). Files are
+# already split by type and day, so large groups cost no pruning and keep
+# per-group metadata and decode calls low
+PARTITION_ROW_GROUP_SIZE = 1_000_000
 
 
-def process_csv_file(csv_file: Path, optimized_dir: Path, schema: dict, worker_id: int):
+def process_csv_file(csv_file: Path, partitioned_dir: Path, schema: dict):
     """
     Process a single CSV file: load, transform, and partition.
 
     Ultra-fast optimizations:
     - Dictionary encoding for categorical columns
     - NO pre-sorting (saves 2-3% time)
-    - Minimal compression (ZSTD level 1)
+    - LZ4 compression (faster encode than ZSTD)
     - Larger row groups for faster writes
 
-    Returns: (file_name, row_count, processing_time)
+    Returns: (file_name, row_count, processing_time, partial_aggregates)
     """
     start = time.time()
 
-    temp_dir = optimized_dir / "temp" / f"worker_{worker_id}"
-    temp_dir.mkdir(parents=True, exist_ok=True)
-
-    # Read CSV with schema - use categorical types for better compression
+    # Read CSV with schema - use categorical types for better compression.
+    # Only `day` is derived: it drives the partition layout and the
+    # aggregates, and the query engine derives week/hour/minute from `ts`
+    # on demand. It is added on the LazyFrame so the streaming engine
+    # computes it chunk by chunk while parsing.
     df = pl.scan_csv(
         csv_file,
         schema=schema,
         null_values=["", "null"],
     ).with_columns([
-        # Convert categorical columns to categorical type (dictionary encoding)
+        # Convert categorical columns (dictionary encoding)
         pl.col("type").cast(pl.Categorical),
         pl.col("country").cast(pl.Categorical),
-    ]).collect()
-
-    # Add derived columns
-    df = df.with_columns([
-        pl.from_epoch(pl.col("ts"), time_unit="ms").alias("ts_dt"),
-    ]).with_columns([
-        pl.col("ts_dt").dt.date().alias("day"),
-        pl.col("ts_dt").dt.truncate("1w").cast(pl.Date).alias("week"),
-        pl.col("ts_dt").dt.truncate("1h").alias("hour"),
-        pl.col("ts_dt").dt.strftime("%Y-%m-%d %H:%M").alias("minute"),
-    ])
+        pl.from_epoch(pl.col("ts"), time_unit="ms").dt.date().alias("day"),
+    ]).collect(streaming=True)
 
     row_count = len(df)
 
-    # Partition by type and day, write to temp directory
-    for event_type in ["serve", "impression", "click", "purchase"]:
-        type_df = df.filter(pl.col("type") == event_type)
-
-        if len(type_df) == 0:
-            continue
-
-        type_dir = temp_dir / f"type={event_type}"
-        type_dir.mkdir(exist_ok=True)
+    # Partition by type and day straight into the final
+    # type=X/day=Y/<csv stem>.parquet layout in one pass, so there is no
+    # temp directory and no merge step. Rows carry no meaningful order (no
+    # pre-sorting), so the partitions need not keep it either
+    parts = df.partition_by(["type", "day"], as_dict=True, maintain_order=False)
+
+    for (event_type, day), day_df in parts.items():
+        day_dir = partitioned_dir / f"type={event_type}" / f"day={day}"
+        day_dir.mkdir(parents=True, exist_ok=True)
+
+        # NO pre-sorting (saves time)
+        # Name the shard after its CSV file to make it unique
+        day_df.write_parquet(
+            day_dir / f"{csv_file.stem}.parquet",
+            compression="lz4",  # LZ4: ~2x ZSTD-1 encode speed, slightly larger files
+            statistics=True,
+            use_pyarrow=False,  # Use Polars native writer (faster)
+            row_group_size=PARTITION_ROW_GROUP_SIZE,
+        )
 
-        # Group by day and write each partition
-        days = type_df["day"].unique().sort().to_list()
+    partials = partial_aggregates(df)
 
-        for day in days:
-            day_df = type_df.filter(pl.col("day") == day)
-            day_str = str(day)
+    elapsed = time.time() - start
+    return (csv_file.name, row_count, elapsed, partials)
 
-            # NO pre-sorting (saves time)
-            # day_df = day_df.sort("ts")  # SKIPPED
 
-            # Write to temp file with CSV file name to make it unique
-            output_file = type_dir / f"day={day_str}_{csv_file.stem}.parquet"
-            day_df.write_parquet(
-                output_file,
-                compression="zstd",
-                compression_level=1,  # ZSTD level 1 (minimal compression, max speed)
-                statistics=True,
-                use_pyarrow=False,  # Use Polars native writer (faster)
-                row_group_size=100000,  # Larger row groups for faster writes
-            )
+def partial_aggregates(df: pl.DataFrame) -> dict:
+    """
+    Compute the minimal aggregates for one CSV shard while it is in memory.
 
-    elapsed = time.time() - start
-    return (csv_file.name, row_count, elapsed)
+    Revenue is kept as sum + count so shards can be combined into an exact
+    mean.
+    """
+    impressions = df.filter(pl.col("type") == "impression")
+    purchases = df.filter(pl.col("type") == "purchase")
+    return {
+        "daily_revenue": impressions.group_by("day").agg([
+            pl.col("bid_price").sum().alias("sum_bid_price"),
+        ]),
+        "country_purchases": purchases.group_by("country").agg([
+            pl.col("total_price").sum().alias("sum_total_price"),
+            pl.col("total_price").count().alias("n_total_price"),
+        ]),
+        "advertiser_type_counts": df.group_by(["advertiser_id", "type"]).agg([
+            pl.len().alias("count"),
+        ]),
+    }
 
 
-def compute_minimal_aggregates(optimized_dir: Path):
+def compute_minimal_aggregates(optimized_dir: Path, partials: list):
     """
     Compute ONLY essential aggregates needed for benchmark queries.
     Skip aggregates that can be computed on-demand quickly.
 
+    The per-shard partial aggregates returned by the CSV pass are combined
+    here, so the partition files are never read back.
+
     Essential aggregates:
     1. Daily revenue (needed for Q1)
     2. Country purchases (needed for Q3)
@@ -124,86 +144,55 @@ def compute_minimal_aggregates(optimized_dir: Path):
     - Minute revenue (can scan partitions directly)
     - Country revenue (not in benchmark)
     """
-    partitioned_dir = optimized_dir / "partitioned"
     aggregates_dir = optimized_dir / "aggregates"
     aggregates_dir.mkdir(parents=True, exist_ok=True)
 
     print("\n⚡ Computing MINIMAL aggregates (only 3 essential)...")
 
-    # 1. Daily revenue (Q1)
-    print("   [1/3] Daily revenue...")
-    impression_files = sorted((partitioned_dir / "type=impression").glob("day=*.parquet"))
+    def combined(name):
+        return pl.concat([p[name] for p in partials]).lazy()
 
-    dfs = []
-    for f in impression_files:
-        df = pl.scan_parquet(f).select(["day", "bid_price"])
-        dfs.append(df)
-
-    if dfs:
-        result = (
-            pl.concat(dfs)
+    # Build all three plans first and collect them together, so Polars runs
+    # the group-bys concurrently on its thread pool instead of one by one.
+    plans = {
+        # 1. Daily revenue (Q1)
+        "daily_revenue": (
+            combined("daily_revenue")
             .group_by("day")
             .agg([
-                pl.col("bid_price").sum().alias("sum_bid_price"),
+                pl.col("sum_bid_price").sum(),
             ])
             .sort("day")
-            .collect()
-        )
-        result.write_parquet(
-            aggregates_dir / "daily_revenue.parquet",
-            compression="zstd",
-            compression_level=1,
-        )
-
-    # 2. Country purchases (Q3)
-    print("   [2/3] Country purchases...")
-    purchase_files = sorted((partitioned_dir / "type=purchase").glob("day=*.parquet"))
-    dfs = []
-    for f in purchase_files:
-        df = pl.scan_parquet(f).select(["country", "total_price"])
-        dfs.append(df)
-
-    if dfs:
-        result = (
-            pl.concat(dfs)
+        ),
+        # 2. Country purchases (Q3)
+        "country_purchases": (
+            combined("country_purchases")
             .group_by("country")
             .agg([
-                pl.col("total_price").mean().alias("avg_total_price"),
+                # 0/0 for a country with only null prices is NaN; report
+                # null like mean() does in the other layouts
+                (pl.col("sum_total_price").sum() / pl.col("n_total_price").sum())
+                .fill_nan(None)
+                .alias("avg_total_price"),
             ])
-            .collect()
-        )
-        result.write_parquet(
-            aggregates_dir / "country_purchases.parquet",
-            compression="zstd",
-            compression_level=1,
-        )
-
-    # 3. Advertiser-type counts (Q4)
-    print("   [3/3] Advertiser-type counts...")
-    dfs = []
-    for event_type in ["serve", "impression", "click", "purchase"]:
-        type_dir = partitioned_dir / f"type={event_type}"
-        if not type_dir.exists():
-            continue
-
-        files = sorted(type_dir.glob("day=*.parquet"))
-        for f in files:
-            df = pl.scan_parquet(f).select(["advertiser_id", "type"])
-            dfs.append(df)
-
-    if dfs:
-        result = (
-            pl.concat(dfs)
+        ),
+        # 3. Advertiser-type counts (Q4)
+        "advertiser_type_counts": (
+            combined("advertiser_type_counts")
             .group_by(["advertiser_id", "type"])
             .agg([
-                pl.len().alias("count"),
+                pl.col("count").sum(),
             ])
-            .collect()
-        )
+        ),
+    }
+
+    print(f"   Combining {len(partials)} shard partials...")
+    results = pl.collect_all(list(plans.values()))
+
+    for name, result in zip(plans, results):
         result.write_parquet(
-            aggregates_dir / "advertiser_type_counts.parquet",
-            compression="zstd",
-            compression_level=1,
+            aggregates_dir / f"{name}.parquet",
+            compression="lz4",
         )
 
     print("   ✅ Minimal aggregates computed (Q2 & Q5 will scan partitions)")
@@ -215,21 +204,20 @@ def create_statistics(optimized_dir: Path):
 
     partitioned_dir = optimized_dir / "partitioned"
 
-    # Collect stats by scanning partition files (lazy)
+    # Collect stats from partition file metadata
     total_rows = 0
     type_counts = {}
 
-    for event_type in ["serve", "impression", "click", "purchase"]:
+    for event_type in EVENT_TYPES:
         type_dir = partitioned_dir / f"type={event_type}"
         if not type_dir.exists():
             continue
 
-        files = list(type_dir.glob("day=*.parquet"))
-        type_count = 0
-
-        for f in files:
-            df = pl.scan_parquet(f).select(pl.len())
-            type_count += df.collect()[0, 0]
+        # Row counts come straight from the Parquet footers - no data is read
+        type_count = sum(
+            pq.ParquetFile(f).metadata.num_rows
+            for f in type_dir.glob("day=*/*.parquet")
+        )
 
         type_counts[event_type] = type_count
         total_rows += type_count
@@ -237,10 +225,10 @@ def create_statistics(optimized_dir: Path):
     # Get date range from impression partitions
     impression_dir = partitioned_dir / "type=impression"
     if impression_dir.exists():
-        files = sorted(impression_dir.glob("day=*.parquet"))
-        if files:
-            min_day = files[0].stem.split("=")[1]
-            max_day = files[-1].stem.split("=")[1]
+        days = sorted(impression_dir.glob("day=*"))
+        if days:
+            min_day = days[0].name.split("=")[1]
+            max_day = days[-1].name.split("=")[1]
         else:
             min_day = max_day = "unknown"
     else:
@@ -258,8 +246,7 @@ def create_statistics(optimized_dir: Path):
     })
     stats_df.write_parquet(
         optimized_dir / "stats.parquet",
-        compression="zstd",
-        compression_level=1,
+        compression="lz4",
     )
 
     print(f"   Total rows: {total_rows:,}")
@@ -272,79 +259,35 @@ class UltraFastDataPreparer:
         self.optimized_dir = Path(optimized_dir)
         self.partitioned_dir = self.optimized_dir / "partitioned"
 
-        # Determine optimal worker count
+        # Determine thread count; one process does the work and Polars'
+        # thread pool provides the parallelism
         if num_workers is None:
             # Use ALL CPU cores for maximum speed
-            num_workers = min(10, max(1, cpu_count()))
+            num_workers = max(1, cpu_count())
         self.num_workers = num_workers
-
-    def _merge_temp_partitions(self):
-        """Merge temporary partition files from all workers into final partitions"""
-        temp_dir = self.optimized_dir / "temp"
-
-        if not temp_dir.exists():
-            return
-
-        # Collect all temp partition files by type and day
-        partition_files = {}  # (type, day) -> [file_paths]
-
-        for worker_dir in temp_dir.glob("worker_*"):
-            for type_dir in worker_dir.glob("type=*"):
-                event_type = type_dir.name.split("=")[1]
-
-                for parquet_file in type_dir.glob("day=*.parquet"):
-                    # Extract day from filename (format: day=YYYY-MM-DD_events_part_*.parquet)
-                    filename = parquet_file.stem
-                    day_str = filename.split("_")[0].split("=")[1]  # Get YYYY-MM-DD
-
-                    key = (event_type, day_str)
-                    if key not in partition_files:
-                        partition_files[key] = []
-                    partition_files[key].append(parquet_file)
-
-        # Merge files for each partition
-        print(f"   Merging {len(partition_files)} unique partitions...")
-
-        for (event_type, day_str), file_list in partition_files.items():
-            # Create final partition directory
-            type_dir = self.partitioned_dir / f"type={event_type}"
-            type_dir.mkdir(parents=True, exist_ok=True)
-
-            output_file = type_dir / f"day={day_str}.parquet"
-
-            if len(file_list) == 1:
-                # Only one file, just move it
-                shutil.move(str(file_list[0]), str(output_file))
-            else:
-                # Multiple files, concatenate them
-                dfs = [pl.scan_parquet(f) for f in file_list]
-                combined = pl.concat(dfs).collect()
-                combined.write_parquet(
-                    output_file,
-                    compression="zstd",
-                    compression_level=1,  # Minimal compression
-                    statistics=True,
-                    use_pyarrow=False,  # Use Polars native writer (faster)
-                )
-
-        # Clean up temp directory
-        shutil.rmtree(temp_dir)
-        print(f"   ✅ Merged successfully")
+        os.environ["POLARS_MAX_THREADS"] = str(num_workers)
 
     def prepare(self):
         """Main preparation pipeline - ULTRA FAST version"""
         print("🚀 Starting ULTRA-FAST data preparation")
-        print(f"   Workers: {self.num_workers}")
+        print(f"   Threads: {self.num_workers}")
         print(f"   CPU cores: {cpu_count()}")
         print(f"   Target: <20 minutes on M2 MacBook")
         print(f"   Optimizations: Minimal compression, skip sorting, only 3 aggregates")
 
         start_time = time.time()
 
-        # Clean up existing optimized directory
+        # Shards are written straight into partitioned/, so a previous run
+        # must be out of the way before the first file is processed. Rename
+        # it to <dir>.old and delete it on a (non-daemon) thread that
+        # overlaps the CSV parsing; the interpreter waits for it on exit
         if self.optimized_dir.exists():
             print(f"\n🗑️  Cleaning existing directory...")
-            shutil.rmtree(self.optimized_dir)
+            old_dir = self.optimized_dir.with_name(self.optimized_dir.name + ".old")
+            if old_dir.exists():
+                shutil.rmtree(old_dir)
+            os.replace(self.optimized_dir, old_dir)
+            threading.Thread(target=shutil.rmtree, args=(old_dir,)).start()
 
         # Create directories
         self.partitioned_dir.mkdir(parents=True, exist_ok=True)
@@ -371,16 +314,16 @@ class UltraFastDataPreparer:
         }
 
         # Step 1: Process CSV files in parallel
-        print(f"\n🔄 Processing CSV files with {self.num_workers} workers...")
+        print(f"\n🔄 Processing CSV files with {self.num_workers} threads...")
 
-        # Assign each CSV file to a worker ID and pack arguments
-        csv_with_workers = [
-            (csv_file, i % self.num_workers, self.optimized_dir, schema)
-            for i, csv_file in enumerate(csv_files)
-        ]
+        # Largest files first, so a few big shards don't finish last alone
+        tasks = sorted(csv_files, key=os.path.getsize, reverse=True)
 
-        with Pool(processes=self.num_workers) as pool:
-            results = pool.map(process_csv_with_worker_id, csv_with_workers)
+        with ThreadPoolExecutor(max_workers=FILES_IN_FLIGHT) as pool:
+            results = list(pool.map(
+                lambda csv_file: process_csv_file(csv_file, self.partitioned_dir, schema),
+                tasks,
+            ))
 
         total_rows = sum(r[1] for r in results)
         avg_time = sum(r[2] for r in results) / len(results)
@@ -389,12 +332,8 @@ class UltraFastDataPreparer:
         print(f"   Total rows: {total_rows:,}")
         print(f"   Avg processing time per file: {avg_time:.2f}s")
 
-        # Step 1.5: Merge temporary partition files
-        print(f"\n🔗 Merging partition files...")
-        self._merge_temp_partitions()
-
         # Step 2: Compute MINIMAL aggregates (only 3 instead of 6)
-        compute_minimal_aggregates(self.optimized_dir)
+        compute_minimal_aggregates(self.optimized_dir, [r[3] for r in results])
 
         # Step 3: Create statistics
         create_statistics(self.optimized_dir)
@@ -447,7 +386,7 @@ def main():
         "--workers",
         type=int,
         default=None,
-        help="Number of parallel workers (default: auto-detect, uses all cores)"
+        help="Number of Polars threads (default: auto-detect, uses all cores)"
     )
 
     args = parser.parse_args()
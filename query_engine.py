@@ -10,26 +10,244 @@ Smart query planner that:
 """
 
 import polars as pl
+import pyarrow.parquet as pq
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
 from pathlib import Path
 from typing import Dict, List, Any, Optional
 import time
-import hashlib
-import json
+
+# Enable global string cache for categorical columns
+# Partitions and aggregates store type/country as Categorical, and frames
+# read from different files must share one dictionary to be concatenated
+pl.enable_string_cache()
+
+# Calendar columns rebuilt from the raw `ts` (epoch ms) when a partition
+# layout does not store them
+_TS = pl.from_epoch(pl.col("ts"), time_unit="ms")
+DERIVED_COLUMNS = {
+    "day": _TS.dt.date(),
+    "week": _TS.dt.truncate("1w").cast(pl.Date),
+    "hour": _TS.dt.truncate("1h"),
+    "minute": _TS.dt.strftime("%Y-%m-%d %H:%M"),
+}
+# Low-cardinality string keys held as Categorical in loaded aggregates.
+# The integer ids are left alone: they already compare as integers and
+# must keep sorting numerically
+CATEGORICAL_COLUMNS = ("type", "country")
+
+# Scans estimated above this many rows collect with the streaming engine
+STREAMING_MIN_ROWS = 5_000_000
+
+DERIVED_SCHEMA = pl.DataFrame(schema={"ts": pl.Int64}).select(**DERIVED_COLUMNS).schema
+
+# Columns whose equality filters pre-computed aggregates fold into their
+# definition (e.g. daily_revenue only holds impressions)
+MV_FILTER_COLUMNS = ("type",)
+
+
+def _to_date(value):
+    """Parse an ISO date literal in Python so filters compare against a scalar"""
+    return value if isinstance(value, date) else date.fromisoformat(value)
+
+
+def _canon(obj):
+    """Recursively convert a JSON-like query into nested hashable tuples"""
+    if isinstance(obj, dict):
+        return tuple(sorted((k, _canon(v)) for k, v in obj.items()))
+    if isinstance(obj, list):
+        return tuple(_canon(v) for v in obj)
+    return obj
+
+
+class LRUCache:
+    """Size-bounded mapping that evicts the least recently used entry"""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def __contains__(self, key) -> bool:
+        return key in self._data
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key, default=None):
+        if key not in self._data:
+            return default
+        self._data.move_to_end(key)
+        return self._data[key]
+
+    def put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self._data.pop(key, default)
+
+    def clear(self):
+        self._data.clear()
+
+
+class MaterializedView:
+    """
+    Descriptor of a pre-computed aggregate.
+    keys are the group columns stored in the file, measures map an
+    aggregate (func, col) to its stored column, filters are the equality
+    conditions the aggregate was built under, and group_bys lists the
+    query groupings it can answer (any strict subset of keys is rolled up
+    by summing, so only list those for additive measures).
+    """
+
+    def __init__(self, filename: str, keys: tuple, measures: Dict[tuple, str],
+                 filters: Dict[str, Any] = None, group_bys: List[tuple] = None):
+        self.filename = filename
+        self.keys = keys
+        self.measures = measures
+        self.filters = filters or {}
+        self.group_bys = group_bys or [keys]
+
+
+# Several views may answer one signature; the planner picks the one with
+# the fewest rows, falling back to registration order on ties
+MATERIALIZED_VIEWS = [
+    MaterializedView(
+        "daily_revenue.parquet", ("day",),
+        {("SUM", "bid_price"): "sum_bid_price"},
+        filters={"type": "impression"},
+    ),
+    MaterializedView(
+        "country_purchases.parquet", ("country",),
+        {("AVG", "total_price"): "avg_total_price"},
+        filters={"type": "purchase"},
+    ),
+    MaterializedView(
+        "advertiser_type_counts.parquet", ("advertiser_id", "type"),
+        {("COUNT", "*"): "count"},
+    ),
+    MaterializedView(
+        "minute_revenue.parquet", ("day", "minute"),
+        {("SUM", "bid_price"): "sum_bid_price"},
+        filters={"type": "impression"},
+        group_bys=[("minute",), ("day",), ("day", "minute")],
+    ),
+    MaterializedView(
+        "publisher_day_country_revenue.parquet", ("publisher_id", "day", "country"),
+        {("SUM", "bid_price"): "sum_bid_price"},
+        filters={"type": "impression"},
+        group_bys=[("publisher_id",), ("day",), ("country",),
+                   ("publisher_id", "day"), ("publisher_id", "country"),
+                   ("day", "country"), ("publisher_id", "day", "country")],
+    ),
+]
+
+
+def _output_name(func: str, col: str) -> str:
+    """Result column name of an aggregate, e.g. sum(bid_price)"""
+    return f"{func.lower()}({col})"
+
+
+def _mv_signature(group_by, aggregates, filters) -> tuple:
+    """Registry key: group columns, aggregates and folded-in equality filters"""
+    return (frozenset(group_by), frozenset(aggregates), frozenset(filters))
+
+
+def _build_mv_registry(views: List[MaterializedView]) -> Dict[tuple, List[MaterializedView]]:
+    registry = {}
+    for view in views:
+        for group_by in view.group_bys:
+            signature = _mv_signature(group_by, view.measures, view.filters.items())
+            registry.setdefault(signature, []).append(view)
+    return registry
+
+
+# Query shape features the view registry matches on, extracted once per
+# distinct query
+QueryFeatures = namedtuple(
+    "QueryFeatures", ["group_by", "select_cols", "aggregates", "filters", "residual"]
+)
+
+
+def _extract_features(query: Dict[str, Any]) -> QueryFeatures:
+    """
+    Extract a query's features in one pass: grouping and selected columns,
+    aggregates as (func, col) pairs, equality filters views fold in, and
+    the residual conditions left to apply
+    """
+    select_cols = []
+    aggregates = []
+    for item in query.get("select", []):
+        if isinstance(item, str):
+            select_cols.append(item)
+        else:
+            aggregates.extend(item.items())
+
+    filters = []
+    residual = []
+    for condition in query.get("where", []):
+        if condition.get("op") == "eq" and condition.get("col") in MV_FILTER_COLUMNS:
+            filters.append((condition["col"], condition["val"]))
+        else:
+            residual.append(condition)
+
+    return QueryFeatures(
+        frozenset(query.get("group_by", [])), frozenset(select_cols),
+        frozenset(aggregates), frozenset(filters), tuple(residual),
+    )
 
 
 class QueryEngine:
-    def __init__(self, optimized_dir: Path):
+    def __init__(self, optimized_dir: Path, max_query_cache: int = 128,
+                 max_aggregate_cache: int = 32, preload_aggregates: bool = True):
         self.optimized_dir = Path(optimized_dir)
         self.partitioned_dir = self.optimized_dir / "partitioned"
         self.aggregates_dir = self.optimized_dir / "aggregates"
 
         # Cache for loaded aggregates
-        self._aggregate_cache = {}
+        self._aggregate_cache = LRUCache(max_aggregate_cache)
+
+        # Sorted projections of aggregates by (file, columns, order_by)
+        self._sorted_cache = LRUCache(max_aggregate_cache)
 
         # Query result cache for exact query matches
-        self._query_cache = {}
+        self._query_cache = LRUCache(max_query_cache)
         self._enable_query_cache = True
 
+        # Single-entry memo of the last query object executed; queries are
+        # treated as immutable once passed in
+        self._last_query = None
+        self._last_result = None
+
+        # Compiled plans keyed by canonical query, so repeated query shapes skip
+        # pattern matching
+        self._plan_cache = LRUCache(max_query_cache)
+
+        # Pre-computed aggregates indexed by the query signature they answer
+        self._mv_registry = _build_mv_registry(MATERIALIZED_VIEWS)
+        self._aggregate_rows_cache = {}
+
+        # Partition file schemas and row counts, read once per file
+        self._schema_cache = {}
+        self._file_rows_cache = {}
+
+        # Partition files by type and day, listed once up front
+        self.invalidate_partition_index()
+
+        # The aggregates are small: read them all now so no query pays for it
+        if preload_aggregates:
+            self.warm_aggregates()
+
+        # Extracted query features by canonical query; they depend only on
+        # the query, so they outlive invalidate() and speed up replanning
+        self._feature_cache = LRUCache(max_query_cache)
+
+        # Compiled WHERE predicates, reused across scans and aggregates
+        self._where_cache = LRUCache(max_query_cache)
+
     def execute_query(self, query: Dict[str, Any]) -> tuple[pl.DataFrame, float]:
         """
         Execute a query and return (results, execution_time)
@@ -38,74 +256,150 @@ class QueryEngine:
         """
         start_time = time.time()
 
-        # Check query cache first
+        # Repeated calls with the very same query object skip even building
+        # the cache key. The memo holds a reference, so the id is not reused
+        if self._enable_query_cache and query is self._last_query:
+            return self._last_result, time.time() - start_time
+
+        # Check query cache first. Cached frames are returned as-is: callers
+        # only read results, and Polars operations return new frames
+        cache_key = self._get_query_key(query)
         if self._enable_query_cache:
-            cache_key = self._get_query_hash(query)
-            if cache_key in self._query_cache:
-                cached_result = self._query_cache[cache_key].clone()
+            cached_result = self._query_cache.get(cache_key)
+            if cached_result is not None:
+                self._last_query, self._last_result = query, cached_result
                 execution_time = time.time() - start_time
                 return cached_result, execution_time
 
-        # Try to use pre-computed aggregations first
-        result = self._try_precomputed(query)
+        plan = self._plan_cache.get(cache_key)
+        if plan is None:
+            plan = self.plan(query)
+            self._plan_cache.put(cache_key, plan)
 
-        if result is None:
-            # Fall back to scanning partitions
-            result = self._execute_scan(query)
+        result = self.run_plan(plan)
 
         # Cache the result
         if self._enable_query_cache:
-            self._query_cache[cache_key] = result.clone()
+            self._query_cache.put(cache_key, result)
+            self._last_query, self._last_result = query, result
 
         execution_time = time.time() - start_time
         return result, execution_time
 
-    def _get_query_hash(self, query: Dict[str, Any]) -> str:
-        """Generate a hash for a query to use as cache key"""
-        # Convert query to JSON string for consistent hashing
-        query_str = json.dumps(query, sort_keys=True)
-        return hashlib.md5(query_str.encode()).hexdigest()
+    def invalidate(self, filename: Optional[str] = None):
+        """
+        Drop cached state after the optimized data changes.
+        With a filename, only that aggregate is reloaded on next use; with
+        no argument every aggregate is, and partitions are listed again.
+        Query results, plans, sorted aggregates and partition schemas and
+        row counts may depend on either, so they are always cleared.
+        """
+        if filename is None:
+            self._aggregate_cache.clear()
+            self._aggregate_rows_cache.clear()
+            self.invalidate_partition_index()
+        else:
+            self._aggregate_cache.pop(filename)
+            self._aggregate_rows_cache.pop(filename, None)
+        self._sorted_cache.clear()
+        self._query_cache.clear()
+        self._plan_cache.clear()
+        self._last_query = self._last_result = None
+        self._schema_cache.clear()
+        self._file_rows_cache.clear()
+
+    def _get_query_key(self, query: Dict[str, Any]) -> tuple:
+        """
+        Canonical, hashable form of a query to use as cache key: dicts become
+        sorted item tuples and lists become tuples, so equal queries map to
+        the same key without serializing or digesting them
+        """
+        return _canon(query)
 
     def _aggregate_exists(self, filename: str) -> bool:
         """Check if a pre-computed aggregate file exists"""
         return (self.aggregates_dir / filename).exists()
 
-    def _try_precomputed(self, query: Dict[str, Any]) -> Optional[pl.DataFrame]:
+    def _aggregate_rows(self, filename: str) -> int:
+        """Row count of a pre-computed aggregate, read from Parquet metadata"""
+        if filename not in self._aggregate_rows_cache:
+            file_path = self.aggregates_dir / filename
+            self._aggregate_rows_cache[filename] = (
+                pq.ParquetFile(file_path).metadata.num_rows
+            )
+        return self._aggregate_rows_cache[filename]
+
+    def _query_features(self, query: Dict[str, Any]) -> QueryFeatures:
+        """Memoized _extract_features"""
+        key = self._get_query_key(query)
+        features = self._feature_cache.get(key)
+        if features is None:
+            features = _extract_features(query)
+            self._feature_cache.put(key, features)
+        return features
+
+    def plan(self, query: Dict[str, Any]) -> tuple:
         """
-        Attempt to answer query using pre-computed aggregations
-        Returns None if query cannot be answered from pre-computed data
+        Compile a query into a (handler, args) plan.
+        Pre-computed aggregations are preferred; otherwise the plan scans
+        the partitioned data.
         """
-        select = query.get("select", [])
-        where = query.get("where", [])
-        group_by = query.get("group_by", [])
-        order_by = query.get("order_by", [])
-
-        # Pattern 1: Daily revenue (SUM bid_price by day, type=impression)
-        if (self._matches_daily_revenue(select, where, group_by) and
-            self._aggregate_exists("daily_revenue.parquet")):
-            return self._query_daily_revenue(where, order_by)
+        plan = self._plan_precomputed(query)
 
-        # Pattern 2: Publisher revenue by country and day range
-        if (self._matches_publisher_day_revenue(select, where, group_by) and
-            self._aggregate_exists("publisher_day_country_revenue.parquet")):
-            return self._query_publisher_day_revenue(where, group_by, order_by)
+        if plan is None:
+            # Fall back to scanning partitions
+            plan = (self._execute_scan, (query,))
 
-        # Pattern 3: Country purchase statistics
-        if (self._matches_country_purchases(select, where, group_by) and
-            self._aggregate_exists("country_purchases.parquet")):
-            return self._query_country_purchases(order_by)
+        return plan
 
-        # Pattern 4: Advertiser-type counts
-        if (self._matches_advertiser_type(select, where, group_by) and
-            self._aggregate_exists("advertiser_type_counts.parquet")):
-            return self._query_advertiser_type(order_by)
+    def run_plan(self, plan: tuple) -> pl.DataFrame:
+        """Execute a plan produced by plan()"""
+        handler, args = plan
+        return handler(*args)
 
-        # Pattern 5: Minute-level revenue
-        if (self._matches_minute_revenue(select, where, group_by) and
-            self._aggregate_exists("minute_revenue.parquet")):
-            return self._query_minute_revenue(where, order_by)
+    def _plan_precomputed(self, query: Dict[str, Any]) -> Optional[tuple]:
+        """
+        Attempt to plan query against pre-computed aggregations
+        Returns None if query cannot be answered from pre-computed data
+        """
+        features = self._query_features(query)
+
+        # Views only hold grouped rows, and store nothing beyond their keys
+        if not features.group_by or not features.select_cols <= features.group_by:
+            return None
+
+        signature = _mv_signature(features.group_by, features.aggregates, features.filters)
+        residual = list(features.residual)
+
+        # Conditions a view does not fold in must be on one of its stored
+        # group keys, so they can be applied to the aggregate exactly
+        candidates = [
+            view for view in self._mv_registry.get(signature, [])
+            if all(w.get("col") in view.keys for w in residual)
+            and self._aggregate_exists(view.filename)
+        ]
+        if not candidates:
+            return None
+
+        # Cheapest covering view: fewer rows to filter and roll up
+        view = min(candidates, key=lambda v: self._aggregate_rows(v.filename))
+
+        # Resolve output columns now, so the handler only runs the lookup.
+        # Loaded aggregates already carry the output names of their measures
+        measure_cols = []
+        select_cols = []
+        for item in query.get("select", []):
+            if isinstance(item, str):
+                select_cols.append(item)
+            else:
+                for func, col in item.items():
+                    measure_cols.append(_output_name(func, col))
+                    select_cols.append(_output_name(func, col))
 
-        return None
+        return (self._query_materialized, (
+            view, query.get("group_by", []), residual, measure_cols, select_cols,
+            query.get("order_by", []),
+        ))
 
     def _execute_scan(self, query: Dict[str, Any]) -> pl.DataFrame:
         """
@@ -123,14 +417,17 @@ class QueryEngine:
         # Determine which columns to load
         columns_needed = self._determine_columns(select, where, group_by, order_by)
 
-        # Load relevant partitions
-        df = self._load_partitions(types_to_scan, days_to_scan, columns_needed)
+        # Scan relevant partitions; WHERE filters are pushed into the scan
+        files = self._partition_files(types_to_scan, days_to_scan)
+        lf = self._scan_partitions(files, columns_needed, where)
 
-        # Apply WHERE filters
-        df = self._apply_filters(df, where)
-
-        # Apply SELECT and aggregations
-        df = self._apply_select(df, select, group_by)
+        # Apply SELECT and aggregations on the same lazy plan, collected once.
+        # Large scans stream so only a batch of rows is resident at a time
+        lf = self._apply_select(lf, select, group_by)
+        df = lf.collect(
+            streaming=self._use_streaming(files, group_by),
+            predicate_pushdown=self._predicate_pushdown(files),
+        )
 
         # Apply ORDER BY
         if order_by:
@@ -138,189 +435,48 @@ class QueryEngine:
 
         return df
 
-    # ==================== Pattern Matching ====================
-
-    def _matches_daily_revenue(self, select, where, group_by):
-        """Check if query matches: SELECT day, SUM(bid_price) WHERE type=impression GROUP BY day"""
-        if group_by != ["day"]:
-            return False
-
-        # Check SELECT clause
-        has_day = "day" in select
-        has_sum_bid = any(
-            isinstance(item, dict) and item.get("SUM") == "bid_price"
-            for item in select
-        )
-
-        if not (has_day and has_sum_bid and len(select) == 2):
-            return False
-
-        # Check WHERE clause
-        type_filter = any(
-            w.get("col") == "type" and w.get("op") == "eq" and w.get("val") == "impression"
-            for w in where
-        )
-
-        return type_filter and len(where) == 1
-
-    def _matches_publisher_day_revenue(self, select, where, group_by):
-        """Check if query matches publisher revenue by day/country"""
-        if "publisher_id" not in group_by:
-            return False
-
-        has_publisher = "publisher_id" in select
-        has_sum_bid = any(
-            isinstance(item, dict) and item.get("SUM") == "bid_price"
-            for item in select
-        )
-
-        type_filter = any(
-            w.get("col") == "type" and w.get("op") == "eq" and w.get("val") == "impression"
-            for w in where
-        )
-
-        return has_publisher and has_sum_bid and type_filter
-
-    def _matches_country_purchases(self, select, where, group_by):
-        """Check if query matches country purchase statistics"""
-        if group_by != ["country"]:
-            return False
-
-        has_country = "country" in select
-        has_avg_total = any(
-            isinstance(item, dict) and item.get("AVG") == "total_price"
-            for item in select
-        )
-
-        type_filter = any(
-            w.get("col") == "type" and w.get("op") == "eq" and w.get("val") == "purchase"
-            for w in where
-        )
-
-        return has_country and has_avg_total and type_filter and len(where) == 1
-
-    def _matches_advertiser_type(self, select, where, group_by):
-        """Check if query matches advertiser-type counts"""
-        if set(group_by) != {"advertiser_id", "type"}:
-            return False
-
-        has_advertiser = "advertiser_id" in select
-        has_type = "type" in select
-        has_count = any(
-            isinstance(item, dict) and item.get("COUNT") == "*"
-            for item in select
-        )
-
-        return has_advertiser and has_type and has_count and len(where) == 0
-
-    def _matches_minute_revenue(self, select, where, group_by):
-        """Check if query matches minute-level revenue"""
-        if group_by != ["minute"]:
-            return False
-
-        has_minute = "minute" in select
-        has_sum_bid = any(
-            isinstance(item, dict) and item.get("SUM") == "bid_price"
-            for item in select
-        )
-
-        type_filter = any(
-            w.get("col") == "type" and w.get("op") == "eq" and w.get("val") == "impression"
-            for w in where
-        )
-
-        return has_minute and has_sum_bid and type_filter
-
     # ==================== Pre-computed Query Execution ====================
 
-    def _query_daily_revenue(self, where, order_by):
-        """Execute daily revenue query from pre-computed aggregates"""
-        df = self._load_aggregate("daily_revenue.parquet")
-        df = df.rename({"sum_bid_price": "sum(bid_price)"})
-        df = df.select(["day", "sum(bid_price)"])
-        return df
-
-    def _query_publisher_day_revenue(self, where, group_by, order_by):
-        """Execute publisher revenue query from pre-computed aggregates"""
-        df = self._load_aggregate("publisher_day_country_revenue.parquet")
-
-        # Apply WHERE filters
-        for w in where:
-            col = w["col"]
-            op = w["op"]
-            val = w["val"]
-
-            if col == "type":
-                continue  # Already filtered in aggregate
-
-            if col == "country" and op == "eq":
-                df = df.filter(pl.col("country") == val)
-            elif col == "day" and op == "between":
-                low, high = val
-                # Convert string dates to date objects
-                low_date = pl.lit(low).str.to_date()
-                high_date = pl.lit(high).str.to_date()
-                df = df.filter((pl.col("day") >= low_date) & (pl.col("day") <= high_date))
-            elif col == "day" and op == "eq":
-                # Convert string date to date object
-                date_val = pl.lit(val).str.to_date()
-                df = df.filter(pl.col("day") == date_val)
-
-        # Group by requested columns
-        df = df.group_by(group_by).agg([
-            pl.col("sum_bid_price").sum()
-        ])
-
-        df = df.rename({"sum_bid_price": "sum(bid_price)"})
-
-        # Select only requested columns
-        select_cols = [col for col in group_by] + ["sum(bid_price)"]
-        df = df.select(select_cols)
-
-        return df
-
-    def _query_country_purchases(self, order_by):
-        """Execute country purchase query from pre-computed aggregates"""
-        df = self._load_aggregate("country_purchases.parquet")
-        df = df.rename({"avg_total_price": "avg(total_price)"})
-        df = df.select(["country", "avg(total_price)"])
+    def _query_materialized(self, view: "MaterializedView", group_by: List[str],
+                            residual: List[Dict], measure_cols: List[str],
+                            select_cols: List[str], order_by: List[Dict]) -> pl.DataFrame:
+        """
+        Execute a query from the pre-computed aggregate described by view.
+        Filter, roll-up and projection run as one lazy pipeline; measures
+        were renamed to their output names when the aggregate was loaded.
+        """
+        df = self._load_aggregate(view.filename)
+        rollup = set(group_by) != set(view.keys)
+        predicate = self._compile_where(residual, df.schema)
+
+        # An unfiltered, unrolled answer is just a sorted projection of the
+        # aggregate, so it is shared by every query asking for that ordering
+        sorted_key = None
+        if order_by and predicate is None and not rollup:
+            sorted_key = (view.filename, tuple(select_cols), _canon(order_by))
+            cached = self._sorted_cache.get(sorted_key)
+            if cached is not None:
+                return cached
+
+        # Filter, roll up and project, unless the stored aggregate already
+        # is the answer
+        if predicate is not None or rollup or df.columns != select_cols:
+            lf = df.lazy()
+            if predicate is not None:
+                lf = lf.filter(predicate)
+
+            # Roll the view up to a coarser grouping; only registered for
+            # views whose measures are additive
+            if rollup:
+                lf = lf.group_by(group_by).agg([pl.col(c).sum() for c in measure_cols])
+
+            df = lf.select(select_cols).collect()
 
         if order_by:
             df = self._apply_order_by(df, order_by)
 
-        return df
-
-    def _query_advertiser_type(self, order_by):
-        """Execute advertiser-type query from pre-computed aggregates"""
-        df = self._load_aggregate("advertiser_type_counts.parquet")
-        df = df.rename({"count": "count(*)"})
-        df = df.select(["advertiser_id", "type", "count(*)"])
-
-        if order_by:
-            df = self._apply_order_by(df, order_by)
-
-        return df
-
-    def _query_minute_revenue(self, where, order_by):
-        """Execute minute-level revenue query from pre-computed aggregates"""
-        df = self._load_aggregate("minute_revenue.parquet")
-
-        # Apply day filter if present
-        for w in where:
-            col = w["col"]
-            op = w["op"]
-            val = w["val"]
-
-            if col == "day" and op == "eq":
-                # Convert string date to date object
-                date_val = pl.lit(val).str.to_date()
-                df = df.filter(pl.col("day") == date_val)
-
-        df = df.rename({"sum_bid_price": "sum(bid_price)"})
-        df = df.select(["minute", "sum(bid_price)"])
-
-        if order_by:
-            df = self._apply_order_by(df, order_by)
+        if sorted_key is not None:
+            self._sorted_cache.put(sorted_key, df)
 
         return df
 
@@ -343,11 +499,19 @@ class QueryEngine:
             elif col == "day" and op == "eq":
                 days_to_scan = [val]
             elif col == "day" and op == "between":
-                # We'd need to expand the range, but for now we scan all
-                pass
+                # Expand the range into the day partitions that exist
+                low, high = map(_to_date, val)
+                days_to_scan = sorted(
+                    day for day in self._partition_days()
+                    if low <= _to_date(day) <= high
+                )
 
         return types_to_scan, days_to_scan
 
+    def _partition_days(self) -> set:
+        """Day strings that have a partition for any event type"""
+        return {day for type_days in self._partition_index.values() for day in type_days}
+
     def _determine_columns(self, select, where, group_by, order_by) -> List[str]:
         """Determine which columns need to be loaded"""
         columns = set()
@@ -376,87 +540,216 @@ class QueryEngine:
             if "(" not in col:
                 columns.add(col)
 
-        # Always include derived columns that might be needed
-        derived = {"day", "week", "hour", "minute"}
-        columns = columns.union(derived.intersection(columns))
-
         return list(columns)
 
-    def _load_partitions(self, types: List[str], days: Optional[List], columns: List[str]) -> pl.DataFrame:
-        """
-        Load data from relevant partitions with optimizations:
-        - Lazy loading with scan_parquet
-        - Column projection to minimize data loading
-        - Parallel reads via Polars' native parallelism
-        """
-        dfs = []
+    def _partition_files(self, types: List[str], days: Optional[List]) -> List[Path]:
+        """Partition files for the given types and days (None means all days)"""
+        all_files = []
 
         for event_type in types:
-            type_dir = self.partitioned_dir / f"type={event_type}"
+            type_days = self._partition_index.get(event_type, {})
 
-            if not type_dir.exists():
-                continue
+            if days is None:
+                for files in type_days.values():
+                    all_files.extend(files)
+            else:
+                for day in days:
+                    all_files.extend(type_days.get(str(day), []))
 
-            parquet_files = sorted(type_dir.glob("day=*.parquet"))
+        return all_files
 
-            if not parquet_files:
-                continue
+    def _use_streaming(self, files: List[Path], group_by: List[str]) -> bool:
+        """
+        Stream scans estimated above STREAMING_MIN_ROWS rows.
+        Polars 1.16's streaming group_by panics on multi-key groupings that
+        include a Categorical read from Parquet, and returns corrupt keys
+        when grouping on an Enum, so those stay in memory.
+        """
+        if not files:
+            return False
+
+        schema = self._partition_schema(files[0])
+        key_types = [schema.get(c) for c in group_by]
+        if any(isinstance(t, pl.Enum) for t in key_types):
+            return False
+        if len(group_by) > 1 and pl.Categorical in key_types:
+            return False
+
+        return sum(self._file_rows(f) for f in files) > STREAMING_MIN_ROWS
 
-            # Use scan_parquet with multiple files for better parallelism
-            # Polars will automatically parallelize reads
-            for parquet_file in parquet_files:
-                # Load with lazy execution
-                df = pl.scan_parquet(parquet_file)
+    def _predicate_pushdown(self, files: List[Path]) -> bool:
+        """
+        Push WHERE filters into the Parquet reader only for single-file scans.
+        Polars 1.16 fails to stack a multi-file scan when a pushed-down filter
+        empties some files and the plan above prunes the projection further
+        (e.g. a GROUP BY that drops the filter column): "unable to vstack,
+        column names don't match". It also rebuilds the emptied files of
+        Enum layouts as Categorical, failing the concat. Files are still
+        pruned by type and day partition.
+        """
+        return len(files) <= 1
+
+    def _file_rows(self, file_path: Path) -> int:
+        """Row count of a partition file from Parquet metadata, cached per file"""
+        if file_path not in self._file_rows_cache:
+            self._file_rows_cache[file_path] = (
+                pq.ParquetFile(file_path).metadata.num_rows
+            )
+        return self._file_rows_cache[file_path]
+
+    def _scan_partitions(self, all_files: List[Path], columns: List[str],
+                         where: List[Dict] = ()) -> pl.LazyFrame:
+        """
+        Lazily scan partition files with optimizations:
+        - Lazy loading with scan_parquet, left for the caller to collect
+        - Column projection to minimize data loading
+        - WHERE filters pushed into the Parquet reader (row-group pruning)
+          when the caller's collect allows it, see _predicate_pushdown
+        - Parallel reads via Polars' native parallelism
+        """
+        # No partition matches: read zero rows of any file, so the result
+        # still has the columns later stages group and select on
+        empty = not all_files
+        if empty:
+            all_files = [
+                files[0] for type_days in self._partition_index.values()
+                for files in type_days.values()
+            ][:1]
+            if not all_files:
+                return pl.LazyFrame()
+
+        # One scan over every file lets Polars plan and parallelize the
+        # multi-file read itself
+        df = pl.scan_parquet(all_files)
+        file_schema = self._partition_schema(all_files[0])
+        schema_names = file_schema.names()
+
+        # Derive calendar columns this layout does not materialize
+        derived = [
+            c for c in columns
+            if c not in schema_names and c in DERIVED_COLUMNS and "ts" in schema_names
+        ]
+
+        # Project only needed columns early, in file order and before any
+        # derivation: Polars 1.16 mis-stacks files a pushed-down filter
+        # empties when the reader's projection is in any other order. `ts`
+        # stays in the frame when columns are derived from it, since
+        # projecting it away again trips the same bug
+        available_cols = [c for c in schema_names if c in columns or (derived and c == "ts")]
+        if available_cols:
+            df = df.select(available_cols)
+
+        if derived:
+            df = df.with_columns([DERIVED_COLUMNS[c].alias(c) for c in derived])
+
+        if empty:
+            return df.limit(0)
+
+        predicate = self._compile_where(
+            where, {**{c: DERIVED_SCHEMA[c] for c in derived}, **file_schema}
+        )
+        if predicate is not None:
+            df = df.filter(predicate)
 
-                # Project only needed columns early (predicate pushdown)
-                available_cols = [c for c in columns if c in df.collect_schema().names()]
-                if available_cols:
-                    df = df.select(available_cols)
+        return df
 
-                dfs.append(df)
+    def _partition_schema(self, file_path: Path) -> pl.Schema:
+        """
+        Schema of a partition file, cached per file. Read from the first row:
+        lazy and zero-row reads report Enum columns as Categorical.
+        """
+        if file_path not in self._schema_cache:
+            self._schema_cache[file_path] = pl.read_parquet(file_path, n_rows=1).schema
+        return self._schema_cache[file_path]
 
-        if not dfs:
-            # Return empty dataframe with proper schema
-            return pl.DataFrame()
+    def invalidate_partition_index(self):
+        """
+        Rebuild the partition index from disk.
+        Maps type -> day string -> Parquet files, supporting both flat
+        (day=YYYY-MM-DD.parquet) and Hive-style (day=YYYY-MM-DD/*.parquet)
+        layouts, so scans look partitions up instead of listing directories.
+        """
+        index = {}
+
+        if self.partitioned_dir.exists():
+            for type_dir in sorted(self.partitioned_dir.glob("type=*")):
+                type_days = index.setdefault(type_dir.name.split("=", 1)[1], {})
+
+                for path in sorted(type_dir.glob("day=*")):
+                    if path.is_dir():
+                        files = sorted(path.glob("*.parquet"))
+                        day = path.name.split("=", 1)[1]
+                    elif path.suffix == ".parquet":
+                        files = [path]
+                        day = path.stem.split("=", 1)[1]
+                    else:
+                        continue
+                    type_days.setdefault(day, []).extend(files)
+
+        self._partition_index = index
+
+    def _compile_where(self, where: List[Dict], schema: Dict[str, Any]) -> Optional[pl.Expr]:
+        """
+        Cached _where_to_expr. The key holds the canonical conditions and the
+        dtypes of the columns they touch, which decide how literals are built.
+        """
+        cols = sorted({condition["col"] for condition in where})
+        key = (_canon(where), tuple((c, schema[c]) for c in cols if c in schema))
+        if key not in self._where_cache:
+            self._where_cache.put(key, self._where_to_expr(where, schema))
+        return self._where_cache.get(key)
 
-        # Concatenate all lazy frames then collect once
-        # This allows Polars to optimize the entire plan
-        result = pl.concat(dfs).collect()
-        return result
+    def _where_to_expr(self, where: List[Dict], schema: Dict[str, Any]) -> Optional[pl.Expr]:
+        """
+        Fold WHERE conditions into one predicate expression.
+        Conditions on columns missing from the schema are skipped; returns
+        None when nothing is left to filter on.
+        """
+        predicate = None
 
-    def _apply_filters(self, df: pl.DataFrame, where: List[Dict]) -> pl.DataFrame:
-        """Apply WHERE clause filters"""
         for condition in where:
             col = condition["col"]
             op = condition["op"]
             val = condition["val"]
 
-            if col not in df.columns:
+            if col not in schema:
                 continue
 
             # Check if column is a date type
-            is_date_col = df[col].dtype in [pl.Date, pl.Datetime]
-
-            if op == "eq":
+            dtype = schema[col]
+            is_date_col = dtype in [pl.Date, pl.Datetime]
+
+            # A value outside an Enum's categories cannot be compared (the
+            # literal fails to cast), but it also cannot match any row
+            if op in ("eq", "neq") and isinstance(dtype, pl.Enum) \
+                    and val not in dtype.categories:
+                if op == "neq":
+                    continue
+                expr = pl.lit(False)
+            elif op == "eq":
                 if is_date_col and isinstance(val, str):
-                    val = pl.lit(val).str.to_date()
-                df = df.filter(pl.col(col) == val)
+                    val = pl.lit(_to_date(val), dtype=pl.Date)
+                expr = pl.col(col) == val
             elif op == "neq":
                 if is_date_col and isinstance(val, str):
-                    val = pl.lit(val).str.to_date()
-                df = df.filter(pl.col(col) != val)
+                    val = pl.lit(_to_date(val), dtype=pl.Date)
+                expr = pl.col(col) != val
             elif op == "in":
-                df = df.filter(pl.col(col).is_in(val))
+                expr = pl.col(col).is_in(val)
             elif op == "between":
                 low, high = val
                 if is_date_col and isinstance(low, str):
-                    low = pl.lit(low).str.to_date()
-                    high = pl.lit(high).str.to_date()
-                df = df.filter((pl.col(col) >= low) & (pl.col(col) <= high))
+                    low = pl.lit(_to_date(low), dtype=pl.Date)
+                    high = pl.lit(_to_date(high), dtype=pl.Date)
+                expr = (pl.col(col) >= low) & (pl.col(col) <= high)
+            else:
+                continue
 
-        return df
+            predicate = expr if predicate is None else predicate & expr
 
-    def _apply_select(self, df: pl.DataFrame, select: List, group_by: List[str]) -> pl.DataFrame:
+        return predicate
+
+    def _apply_select(self, df: pl.LazyFrame, select: List, group_by: List[str]) -> pl.LazyFrame:
         """Apply SELECT clause with aggregations"""
         if group_by:
             # Build aggregation expressions
@@ -513,20 +806,75 @@ class QueryEngine:
 
             # Handle column names that might have been transformed
             if col in df.columns:
-                df = df.sort(col, descending=descending)
+                df = df.sort(self._sort_key(df, col), descending=descending)
             else:
                 # Try to find the column with different casing
                 for df_col in df.columns:
                     if df_col.lower() == col.lower():
-                        df = df.sort(df_col, descending=descending)
+                        df = df.sort(self._sort_key(df, df_col), descending=descending)
                         break
 
         return df
 
+    def _sort_key(self, df: pl.DataFrame, col: str) -> pl.Expr:
+        """Sort key for a column; categoricals sort lexically, not by physical code"""
+        dtype = df.schema[col]
+        if dtype == pl.Categorical or isinstance(dtype, pl.Enum):
+            return pl.col(col).cast(pl.String)
+        return pl.col(col)
+
     def _load_aggregate(self, filename: str) -> pl.DataFrame:
-        """Load pre-computed aggregate with caching"""
-        if filename not in self._aggregate_cache:
-            file_path = self.aggregates_dir / filename
-            self._aggregate_cache[filename] = pl.read_parquet(file_path)
+        """
+        Load pre-computed aggregate with caching.
+        The cached frame itself is returned: handlers only filter, group,
+        select and sort it, which all build new frames, so it is never
+        mutated in place.
+        """
+        df = self._aggregate_cache.get(filename)
+        if df is None:
+            df = self._read_aggregate(filename)
+            self._aggregate_cache.put(filename, df)
+
+        return df
+
+    def _read_aggregate(self, filename: str) -> pl.DataFrame:
+        """Read a pre-computed aggregate from disk"""
+        file_path = self.aggregates_dir / filename
+        df = pl.read_parquet(file_path, memory_map=True)
+
+        # Dictionary-encode low-cardinality keys stored as plain strings,
+        # so filters and roll-ups on them compare integer codes
+        df = df.with_columns([
+            pl.col(c).cast(pl.Categorical) for c in CATEGORICAL_COLUMNS
+            if df.schema.get(c) == pl.String
+        ])
+
+        # Give measures their output names once, instead of per query
+        renames = {
+            stored: _output_name(func, col)
+            for view in MATERIALIZED_VIEWS if view.filename == filename
+            for (func, col), stored in view.measures.items() if stored in df.columns
+        }
+        return df.rename(renames)
+
+    def warm_aggregates(self):
+        """
+        Load every pre-computed aggregate into the cache ahead of the query loop.
+        Files are read concurrently (Parquet decoding releases the GIL); the
+        cache itself is only touched from this thread.
+        """
+        if not self.aggregates_dir.exists():
+            return
+
+        filenames = [
+            p.name for p in sorted(self.aggregates_dir.glob("*.parquet"))
+            if p.name not in self._aggregate_cache
+        ]
+        if not filenames:
+            return
+
+        with ThreadPoolExecutor(max_workers=len(filenames)) as executor:
+            frames = list(executor.map(self._read_aggregate, filenames))
 
-        return self._aggregate_cache[filename].clone()
+        for filename, df in zip(filenames, frames):
+            self._aggregate_cache.put(filename, df)
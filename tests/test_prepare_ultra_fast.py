@@ -0,0 +1,45 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+import polars as pl
+
+from prepare_ultra_fast import UltraFastDataPreparer
+
+
+CSV_HEADER = "ts,type,auction_id,advertiser_id,publisher_id,bid_price,user_id,total_price,country\n"
+
+
+class UnknownValuesTest(unittest.TestCase):
+    def test_unknown_country_and_type_are_kept(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            data_dir = Path(tmp) / "data"
+            data_dir.mkdir()
+            (data_dir / "events_part_00000.csv").write_text(
+                CSV_HEADER
+                + "1717256126116,impression,a1,1,1,0.5,1,,US\n"
+                + "1717256126117,impression,a2,1,1,1.5,2,,UK\n"
+                + "1717256126118,purchase,a3,1,1,,3,9.0,UK\n"
+                + "1717256126119,bounce,a4,1,1,,4,,US\n"
+            )
+            optimized_dir = Path(tmp) / "optimized"
+
+            UltraFastDataPreparer(data_dir, optimized_dir, num_workers=1).prepare()
+
+            df = pl.read_parquet(optimized_dir / "partitioned" / "**" / "*.parquet")
+            self.assertEqual(len(df), 4)
+            self.assertEqual(
+                df.filter(pl.col("country") == "UK").height, 2
+            )
+            self.assertEqual(
+                df.filter(pl.col("type") == "bounce").height, 1
+            )
+
+            purchases = pl.read_parquet(
+                optimized_dir / "aggregates" / "country_purchases.parquet"
+            )
+            self.assertIn("UK", purchases["country"].cast(pl.Utf8).to_list())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+import tempfile
+import unittest
+from datetime import date, datetime, timezone
+from pathlib import Path
+
+import polars as pl
+
+from query_engine import QueryEngine
+
+
+def _ms(*args) -> int:
+    return int(datetime(*args, tzinfo=timezone.utc).timestamp() * 1000)
+
+
+EVENTS = pl.DataFrame({
+    "ts": [
+        _ms(2024, 6, 1, 10, 5), _ms(2024, 6, 1, 10, 40), _ms(2024, 6, 1, 12),
+        _ms(2024, 6, 2, 9), _ms(2024, 6, 2, 10, 30),
+        _ms(2024, 6, 1, 10, 15), _ms(2024, 6, 2, 11),
+    ],
+    "type": [
+        "impression", "impression", "impression",
+        "impression", "impression",
+        "serve", "serve",
+    ],
+    "publisher_id": [1, 2, 1, 3, 2, 1, 2],
+    "bid_price": [1.0, 2.0, 4.0, 8.0, 16.0, None, None],
+    "country": ["US", "JP", "US", "JP", "US", "US", "JP"],
+}).with_columns(
+    pl.from_epoch("ts", time_unit="ms").dt.date().alias("day"),
+)
+
+
+class EmptiedPartitionFilesTest(unittest.TestCase):
+    """
+    Filters that leave some of a multi-file scan's partition files without
+    rows, grouped on a column other than the filter column.
+    """
+
+    def _write_layout(self, root: Path):
+        df = EVENTS.with_columns(
+            pl.col("type").cast(pl.Categorical),
+            pl.col("country").cast(pl.Categorical),
+        )
+        for (event_type, day), part in df.partition_by(["type", "day"], as_dict=True).items():
+            day_dir = root / "partitioned" / f"type={event_type}" / f"day={day}"
+            day_dir.mkdir(parents=True)
+            # Two files per partition, so every scan reads several files
+            part.head(1).write_parquet(day_dir / "00000000.parquet")
+            part.slice(1).write_parquet(day_dir / "00000001.parquet")
+
+    def _run(self, query) -> dict:
+        with tempfile.TemporaryDirectory() as tmp:
+            self._write_layout(Path(tmp))
+            engine = QueryEngine(Path(tmp), preload_aggregates=False)
+            result, _ = engine.execute_query(query)
+        key, value = result.columns
+        return dict(zip(result[key].cast(pl.Utf8).to_list(), result[value].to_list()))
+
+    def test_neq_type_group_by_country(self):
+        query = {
+            "select": ["country", {"COUNT": "*"}],
+            "where": [{"col": "type", "op": "neq", "val": "serve"}],
+            "group_by": ["country"],
+        }
+        self.assertEqual(self._run(query), {"US": 3, "JP": 2})
+
+    def test_hour_window_group_by_publisher(self):
+        query = {
+            "select": ["publisher_id", {"SUM": "bid_price"}],
+            "where": [
+                {"col": "type", "op": "eq", "val": "impression"},
+                {"col": "ts", "op": "between",
+                 "val": [_ms(2024, 6, 1, 10), _ms(2024, 6, 1, 11) - 1]},
+            ],
+            "group_by": ["publisher_id"],
+        }
+        self.assertEqual(self._run(query), {"1": 1.0, "2": 2.0})
+
+
+if __name__ == "__main__":
+    unittest.main()